@@ -27,18 +27,25 @@
 #   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307,
 #   USA.
 #
+import functools
 import getpass
 import hashlib
 import imaplib
 import os
+import pathlib
 import argparse
 import re
 import socket
+import sqlite3
 import sys
+import threading
 import time
-from typing import List, Dict, Tuple, Optional, Type, Any
+from collections import deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Tuple, Optional, Type, Any, Iterator, Callable
 
-from email.parser import BytesParser
+from email.parser import BytesHeaderParser
 from email.message import Message
 from email.errors import HeaderParseError
 from email.header import decode_header
@@ -167,6 +174,26 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         action="store_true",
         help="Delete marked messages (expunge)"
     )
+    parser.add_argument(
+        "--cache",
+        dest="cache_path",
+        help="Remember the messages checked in this SQLite file, so that later runs only need to fetch new ones",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Read up to this many mailboxes at once, each over its own connection (at most 8)",
+    )
+    parser.add_argument(
+        "--rate-limit-ms",
+        dest="rate_limit_ms",
+        type=int,
+        default=0,
+        help="Pause for this many milliseconds between batches of commands, for servers which throttle clients",
+    )
     parser.add_argument('mailbox', nargs='*')
 
     options = parser.parse_args(args)
@@ -187,6 +214,22 @@ def get_arguments(args: Optional[List[str]] = None) -> Tuple[argparse.Namespace,
         sys.stderr.write("\nError: If you use -m you must also use -c.\n")
         sys.exit(1)
 
+    if options.rate_limit_ms < 0:
+        sys.stderr.write("\nError: --rate-limit-ms can't be negative.\n")
+        sys.exit(1)
+
+    if not 1 <= options.workers <= 8:
+        sys.stderr.write("\nError: The number of workers must be between 1 and 8.\n")
+        sys.exit(1)
+
+    if options.cache_path and options.workers > 1:
+        sys.stderr.write("\nError: You can't use --cache with -j.\n")
+        sys.exit(1)
+
+    if options.cache_path and options.sent_before:
+        sys.stderr.write("\nError: You can't use --cache with -b.\n")
+        sys.exit(1)
+
     if options.keyring == '':
         options.keyring = options.server
 
@@ -213,58 +256,125 @@ def parse_list_response(line: bytes):
     if m is None:
         sys.stderr.write(f"\nError: parsing list response '{line}'")
         sys.exit(1)
-    flags, delimiter, mailbox_name = m.groups()
-    mailbox_name = mailbox_name.strip(b'"')
-    return (flags, delimiter, mailbox_name)
+    return (m["flags"], m["delimiter"], m["name"].strip(b'"'))
 
 def str_header(parsed_message: Message, name: str) -> str:
     """
     Return the value (of the first instance, if more than one) of
     the given header, as a unicode string.
     """
-    hdrlist = decode_header(parsed_message.get(name, ""))
-    btext, charset = hdrlist[0]
+    value = parsed_message.get(name, "")
+    if not isinstance(value, str):
+        # Headers with 8-bit content come back as (unhashable) Header objects.
+        return decode_header_text.__wrapped__(value)
+    if "=?" not in value:
+        # No RFC 2047 encoded words, so nothing to decode.
+        return value.lstrip()
+    return decode_header_text(value)
+
+@functools.lru_cache(maxsize=4096)
+def decode_header_text(value: Any) -> str:
+    """
+    Decode a header value, returning the first part as a unicode string.
+    Mailing lists repeat the same encoded From, To and Subject lines over
+    and over, so recent results are cached.
+    """
+    btext, charset = decode_header(value)[0]
     text = btext if isinstance(btext, str) else btext.decode("utf-8", "ignore")
     return text.lstrip()
 
+# Headers combined into the -c checksum, in the order in which they are hashed.
+checksum_headers = ("From", "To", "Subject", "Date", "Cc", "Bcc")
+
+def first_headers(parsed_message: Message, names: Tuple[str, ...]) -> Dict[str, str]:
+    """
+    Return the raw, undecoded value of the first instance of each of the
+    given headers which is present, keyed on the lower-cased header name,
+    in a single pass over the message's headers.
+    """
+    wanted = frozenset(name.lower() for name in names)
+    found: Dict[str, str] = {}
+    for name, value in parsed_message.raw_items():
+        key = name.lower()
+        if key in wanted and key not in found:
+            found[key] = value
+    return found
+
+def bytes_header(value: str) -> bytes:
+    """
+    Return a raw header value from first_headers as the bytes it was
+    parsed from.  The parser decodes headers as ASCII, keeping any other
+    bytes as surrogate escapes, so this round trip is exact and cheap.
+    """
+    return value.encode("ascii", "surrogateescape").lstrip()
+
+def fingerprint_headers(fields: List[bytes]) -> bytes:
+    """
+    Return the checksum of a list of "Name:value" header fields, hashed
+    as a single buffer in one call into hashlib.
+    """
+    return hashlib.blake2b(b"\n".join(fields), digest_size=16).digest()
+
+def fingerprint_message_id(msg_id: bytes) -> bytes:
+    """
+    Return the key for a message with the given, stripped, Message-ID.
+    The ID is hashed so that keys are short and of a fixed size, however
+    long it is.
+    """
+    return hashlib.blake2b(msg_id, digest_size=16).digest()
+
+# The first Message-ID header, possibly folded, whatever its value.  Checking
+# the value separately stops the search from skipping ahead to a later one,
+# which the parser would ignore.
+message_id_pattern = re.compile(rb"^Message-ID:[ \t]*((?:[^\n]|\n[ \t])*)", re.I | re.M)
+# A header value which is plain printable ASCII.
+plain_value_pattern = re.compile(rb"(?:[\x20-\x7e\t]|\r\n[ \t]|\n[ \t])*\r?")
+
+def get_raw_message_id(header_bytes: bytes) -> Optional[bytes]:
+    """
+    Return the same key as get_message_id would, read straight from the
+    unparsed header bytes, or None if there's no simple Message-ID, in
+    which case the headers should be parsed and passed to get_message_id.
+    """
+    m = message_id_pattern.search(header_bytes)
+    if m is None or not plain_value_pattern.fullmatch(m[1]):
+        return None
+    msg_id = m[1].strip()
+    if not msg_id or b"=?" in msg_id:
+        return None
+    return fingerprint_message_id(msg_id)
+
 def get_message_id(
-    parsed_message: Message, options_use_checksum=False, options_use_id_in_checksum=False
-) -> Optional[str]:
+    parsed_message: Message, options_use_checksum=False, options_use_id_in_checksum=False,
+    log: Callable[[str], None] = print
+) -> Optional[bytes]:
     """
-    Normally, return the Message-ID header (or print a warning if it doesn't
-    exist and return None).
+    Normally, return a 16-byte BLAKE2b digest of the Message-ID header (or
+    print a warning if it doesn't exist and return None).  Warnings are
+    passed to log, which prints them by default.
 
-    If options_use_checksum is specified, use md5 hash of several headers
-    instead.
+    If options_use_checksum is specified, return a 16-byte BLAKE2b digest
+    of several headers instead.
 
     For more safety, user should first do a dry run, reviewing them before
-    deletion. Problems are extremely unlikely, but md5 is not collision-free.
+    deletion. Problems are extremely unlikely, but no hash is collision-free.
 
     If options_use_id_in_checksum is specified, then the Message-ID will be
     included in the header checksum, otherwise it is excluded.
     """
     try:
         if options_use_checksum:
-            md5 = hashlib.md5()
-            sha = hashlib.sha256()
-            sha3 = hashlib.sha3_256()
-            def update(x):
-                md5.update(x)
-                sha.update(x)
-                sha3.update(x)
-            update(("From:" + str_header(parsed_message, "From")).encode())
-            update(("To:" + str_header(parsed_message, "To")).encode())
-            update(("Subject:" + str_header(parsed_message, "Subject")).encode())
-            update(("Date:" + str_header(parsed_message, "Date")).encode())
-            update(("Cc:" + str_header(parsed_message, "Cc")).encode())
-            update(("Bcc:" + str_header(parsed_message, "Bcc")).encode())
-            if options_use_id_in_checksum:
-                update(("Message-ID:" + str_header(parsed_message, "Message-ID")).encode())
-            msg_id = md5.hexdigest() + "|" + sha.hexdigest() + "|" + sha3.hexdigest()
+            wanted = checksum_headers + ("Message-ID",) if options_use_id_in_checksum else checksum_headers
+            raw = first_headers(parsed_message, wanted)
+            fields = [
+                name.encode() + b":" + (bytes_header(raw[name.lower()]) if name.lower() in raw else b"")
+                for name in wanted
+            ]
+            return fingerprint_headers(fields)
         else:
             msg_id = str_header(parsed_message, "Message-ID")
             if not msg_id:
-                print(
+                log(
                     (
                         "Message '%s' dated '%s' has no Message-ID header."
                         % (
@@ -273,16 +383,16 @@ def get_message_id(
                         )
                     )
                 )
-                print("You might want to use the -c option.")
+                log("You might want to use the -c option.")
                 return None
-        return msg_id.lstrip()
+        return fingerprint_message_id(msg_id.strip().encode())
 
     except (ValueError, HeaderParseError):
-        print(
+        log(
             "WARNING: There was an exception trying to parse the headers of this message."
         )
-        print("It may be corrupt, and you might consider deleting it.")
-        print(
+        log("It may be corrupt, and you might consider deleting it.")
+        log(
             (
                 "Subject: %s\nFrom: %s\nDate: %s\n"
                 % (
@@ -292,7 +402,7 @@ def get_message_id(
                 )
             )
         )
-        print("Message skipped.")
+        log("Message skipped.")
         return None
 
 def get_mailbox_list(server: imaplib.IMAP4, directory: str = '""', pattern: str = '"*"') -> List[str]:
@@ -308,67 +418,170 @@ def get_mailbox_list(server: imaplib.IMAP4, directory: str = '""', pattern: str
             resp.append(bits[2].decode())
     return resp
 
-def get_matching_msgnums(server: imaplib.IMAP4, query: str, sent_before: Optional[str]) -> List[int]:
+# Parts of an ESEARCH response (RFC 4731).
+esearch_count_pattern = re.compile(rb"\bCOUNT (\d+)")
+esearch_all_pattern = re.compile(rb"\bALL ([0-9:,]+)")
+
+def esearch(server: imaplib.IMAP4, returns: str, query: str, uid: bool = False) -> bytes:
+    """
+    Issue a 'SEARCH RETURN (...)' command, which servers advertising the
+    ESEARCH capability support, and return the data of the ESEARCH
+    response, or an empty string if the server didn't send one.
+    If uid is True, a 'UID SEARCH' is issued instead.
+    """
+    command = ("UID", "SEARCH") if uid else ("SEARCH",)
+    typ, dat = server._simple_command(*command, "RETURN", f"({returns})", query)
+    data = check_response(server._untagged_response(typ, dat, "ESEARCH"))
+    return b" ".join(d for d in data if d)
+
+def expand_seqset(seqset: bytes) -> Iterator[int]:
+    """
+    Generate the numbers in an IMAP sequence set such as b"1:500,502,600:700".
+    """
+    for part in seqset.split(b","):
+        first, _, last = part.partition(b":")
+        yield from range(int(first), int(last or first) + 1)
+
+def compress_seqset(msg_ids: List[int]) -> str:
+    """
+    Return an IMAP sequence set covering the given message numbers, with
+    runs of consecutive numbers collapsed into ranges, e.g. "1:5,17,42:100".
+    """
+    runs: List[List[int]] = []
+    for n in sorted(msg_ids):
+        if runs and n <= runs[-1][1] + 1:
+            runs[-1][1] = max(runs[-1][1], n)
+        else:
+            runs.append([n, n])
+    return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in runs)
+
+def get_matching_msgnums(server: imaplib.IMAP4, query: str, sent_before: Optional[str],
+                         uid: bool = False, log: Callable[[str], None] = print) -> List[int]:
     """
     Return a list of ids of messages in the folder matching the given query.
+    If uid is True, these are UIDs rather than message sequence numbers.
     """
     resp = []
     if sent_before is not None:
         query = f"{query} SENTBEFORE {sent_before}"
-        print(f"Getting matching messages sent before {sent_before}")
-    deleted_info = check_response(server.search(None, query))
+        log(f"Getting matching messages sent before {sent_before}")
+    if "ESEARCH" in server.capabilities:
+        # The matches come back as a compact sequence set.
+        m = esearch_all_pattern.search(esearch(server, "ALL", query, uid))
+        return list(expand_seqset(m[1])) if m else []
+    if uid:
+        deleted_info = check_response(server.uid("SEARCH", query))
+    else:
+        deleted_info = check_response(server.search(None, query))
     if deleted_info and deleted_info[0]:   
         # If neither None nor empty nor [None], then
         # the first item should be a list of msg ids
         resp = [int(n) for n in deleted_info[0].split()]
     return resp
 
-def get_deleted_msgnums(server: imaplib.IMAP4, sent_before: Optional[str]) -> List[int]:
+def count_matching_msgnums(server: imaplib.IMAP4, query: str, sent_before: Optional[str],
+                           log: Callable[[str], None] = print) -> int:
     """
-    Return a list of ids of deleted messages in the folder.
+    Return the number of messages in the folder matching the given query,
+    asking the server just for the count if it supports ESEARCH.
     """
-    return get_matching_msgnums(server, "DELETED", sent_before)
+    if "ESEARCH" not in server.capabilities:
+        return len(get_matching_msgnums(server, query, sent_before, log=log))
+    if sent_before is not None:
+        query = f"{query} SENTBEFORE {sent_before}"
+        log(f"Getting matching messages sent before {sent_before}")
+    m = esearch_count_pattern.search(esearch(server, "COUNT", query))
+    return int(m[1]) if m else 0
 
-def get_undeleted_msgnums(server: imaplib.IMAP4, sent_before: Optional[str]) -> List[int]:
+def get_undeleted_msgnums(server: imaplib.IMAP4, sent_before: Optional[str],
+                          log: Callable[[str], None] = print) -> List[int]:
     """
     Return a list of ids of non-deleted messages in the folder.
     """
-    return get_matching_msgnums(server, "UNDELETED", sent_before)
-
-def get_tagged_msgnums(server: imaplib.IMAP4, tag_name: str, sent_before: Optional[str]) -> List[int]:
-    """
-    Return a list of ids of tagged messages in the folder.
-    """
-    return get_matching_msgnums(server, f"KEYWORD {tag_name}", sent_before)
+    return get_matching_msgnums(server, "UNDELETED", sent_before, log=log)
 
 # Updated get_msg_headers with a retry mechanism and pause
-def get_msg_headers(server: imaplib.IMAP4, msg_ids: List[int], retries: int = 3, pause: int = 5) -> List[Tuple[int, bytes]]:
+def get_msg_headers(server: imaplib.IMAP4, msg_ids: List[int], retries: int = 3, pause: int = 5,
+                    fields: Optional[List[str]] = None,
+                    log: Callable[[str], None] = print) -> Iterator[Tuple[int, int, bytes]]:
     """
-    Get the header bytes for each message in the provided list of IDs,
+    Get the UID and header bytes for each message in the provided list of IDs,
     with a retry mechanism if the fetch response is incomplete.
-    Returns a list of tuples: (msgid, header_bytes).
+    If a list of header names is given, only those headers are fetched,
+    otherwise the whole header block is.
+    The FETCH is complete when this returns, and the result is an
+    iterator of tuples: (msgid, uid, header_bytes).
     """
-    message_ids_str = ",".join(map(str, msg_ids))
+    message_ids_str = compress_seqset(msg_ids)
+    if fields:
+        # BODY.PEEK, unlike BODY, doesn't set the \Seen flag.
+        message_parts = "(UID BODY.PEEK[HEADER.FIELDS (%s)])" % " ".join(fields).upper()
+    else:
+        message_parts = "(UID RFC822.HEADER)"
     for attempt in range(retries):
         try:
-            ms = check_response(server.fetch(message_ids_str, "(RFC822.HEADER)"))
-            # Check if we got the expected number of response parts (2 parts per message)
-            if len(ms) < len(msg_ids) * 2:
+            ms = check_response(server.fetch(message_ids_str, message_parts))
+            # Check if we got a header for every message
+            if sum(isinstance(m, tuple) for m in ms) < len(msg_ids):
                 raise ValueError("Incomplete fetch response")
             break  # Successful fetch, exit retry loop.
         except Exception as e:
-            print(f"Error fetching headers for messages {msg_ids[0]}-{msg_ids[-1]} (attempt {attempt + 1}/{retries}): {e}")
+            log(f"Error fetching headers for messages {min(msg_ids)}-{max(msg_ids)} (attempt {attempt + 1}/{retries}): {e}")
             if attempt < retries - 1:
-                time.sleep(pause)
+                time.sleep(pause * 2 ** attempt)
             else:
                 raise
-    headers = []
-    count = min(len(ms) // 2, len(msg_ids))
-    for ci in range(count):
-        mnum = int(msg_ids[ci])
-        header_tuple = ms[ci * 2]
-        headers.append((mnum, header_tuple[1]))
-    return headers
+    return iter_fetched_headers(ms)
+
+# The UID in a FETCH response, which may come before or after the header literal.
+fetch_uid_pattern = re.compile(rb"\bUID (\d+)", re.I)
+
+def iter_fetched_headers(ms: List[Any]) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Yield (msgid, uid, header_bytes) for each message in a FETCH response,
+    dropping the response's reference to each header as it is yielded,
+    so that only the one being processed need stay in memory.
+    Unsolicited FETCH responses without a header, such as flag changes
+    made by other clients, are skipped.
+    """
+    for i, part in enumerate(ms):
+        if not isinstance(part, tuple):
+            continue
+        prefix, header = part
+        ms[i] = None
+        m = fetch_uid_pattern.search(prefix)
+        if m is None and i + 1 < len(ms) and isinstance(ms[i + 1], bytes):
+            m = fetch_uid_pattern.search(ms[i + 1])
+        if m is None:
+            raise ValueError("No UID in fetch response for message %s" % prefix.split()[0].decode())
+        yield (int(prefix.split()[0]), int(m.group(1)), header)
+
+def prefetch_msg_headers(server: imaplib.IMAP4, msg_ids: List[int], chunk_size: int,
+                         fields: Optional[List[str]] = None, window: int = 2, interval: float = 0,
+                         log: Callable[[str], None] = print) -> Iterator[Tuple[int, "Future[Iterator[Tuple[int, int, bytes]]]"]]:
+    """
+    Fetch the headers of the given messages in chunks, yielding
+    (offset, future) pairs in order.  Up to 'window' fetches are queued
+    ahead, so the next chunk is on the wire while the caller parses the
+    current one.  A single worker thread issues the FETCH commands, so
+    the connection itself only ever sees one command at a time, and the
+    caller must not use the server until the iterator is exhausted.
+    If an interval is given, the worker waits that many seconds before
+    each FETCH after the first.  Errors are passed to log.
+    """
+    def fetch(chunk: List[int], delay: float) -> Iterator[Tuple[int, int, bytes]]:
+        if delay:
+            time.sleep(delay)
+        return get_msg_headers(server, chunk, fields=fields, log=log)
+
+    with ThreadPoolExecutor(max_workers=1) as fetcher:
+        pending: deque = deque()
+        for i in range(0, len(msg_ids), chunk_size):
+            pending.append((i, fetcher.submit(fetch, msg_ids[i: i + chunk_size], interval if i else 0)))
+            if len(pending) >= window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
 
 def print_message_info(parsed_message: Message):
     print("From: " + str_header(parsed_message, "From"))
@@ -384,7 +597,116 @@ def add_quotes(mbox: str) -> str:
         mbox = '"' + mbox + '"'
     return mbox
 
-def process(options, mboxes: List[str]):
+class FingerprintCache:
+    """
+    An SQLite record of the messages which earlier runs kept as the first
+    copy of each message, identified by account, mailbox, UIDVALIDITY and
+    UID, so that their headers needn't be fetched and checked again.  The
+    account matters because different servers, or different users on the
+    same one, can easily have mailboxes with the same name, UIDVALIDITY
+    and UIDs.  A read-only cache, as used for dry runs, is consulted but
+    never changed.
+    """
+
+    # Increase this whenever get_message_id changes what it returns, or
+    # the table changes, so that rows recorded by older versions are discarded.
+    version = 4
+
+    def __init__(self, path: str, account: str, method: str, readonly: bool = False):
+        self.account = account
+        self.method = method
+        self.readonly = readonly
+        self.uidvalidity: Optional[int] = None
+        self.db: Optional[sqlite3.Connection] = None
+        if readonly:
+            # A missing or out-of-date cache file is simply treated as empty.
+            try:
+                db = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+                if db.execute("PRAGMA user_version").fetchone()[0] == self.version:
+                    self.db = db
+                else:
+                    db.close()
+            except sqlite3.Error:
+                pass
+            return
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.execute("DROP TABLE IF EXISTS messages")
+            self.db.execute(f"PRAGMA user_version = {self.version}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "account TEXT, method TEXT, mbox TEXT, uidvalidity INTEGER, uid INTEGER, fp BLOB, "
+            "PRIMARY KEY (account, method, mbox, uidvalidity, uid))"
+        )
+        self.db.commit()
+
+    def load(self, server: imaplib.IMAP4, mbox: str, uidvalidity: Optional[int], msgnums: List[int],
+             msg_ids: Dict[bytes, Tuple[str, int]]) -> List[int]:
+        """
+        Add the cached fingerprints of the given undeleted messages in the
+        selected mailbox, whose UIDVALIDITY is given, to msg_ids, and
+        return the numbers of the rest, which still need to be fetched.
+        Cached messages which are no longer there, or which are now
+        duplicates of messages found earlier in this run, are forgotten.
+        """
+        self.uidvalidity = uidvalidity
+        if self.uidvalidity is None or self.db is None:
+            return msgnums
+        uids = get_matching_msgnums(server, "UNDELETED", None, uid=True)
+        if len(uids) != len(msgnums):
+            # The mailbox changed under us; don't trust the cache this time.
+            return msgnums
+
+        key = (self.account, self.method, mbox, self.uidvalidity)
+        cached = dict(self.db.execute(
+            "SELECT uid, fp FROM messages WHERE account = ? AND method = ? AND mbox = ? AND uidvalidity = ?", key
+        ))
+        to_fetch = []
+        stale = []
+        for mnum, uid in zip(msgnums, uids):
+            fp = cached.pop(uid, None)
+            if fp is not None and fp not in msg_ids:
+                msg_ids[fp] = (mbox, mnum)
+            else:
+                to_fetch.append(mnum)
+                if fp is not None:
+                    stale.append(uid)
+        # Whatever is left has been deleted or expunged since it was cached.
+        stale.extend(cached)
+
+        if not self.readonly:
+            with self.db:
+                # A new UIDVALIDITY means the old UIDs no longer identify the same messages.
+                self.db.execute("DELETE FROM messages WHERE account = ? AND method = ? AND mbox = ? AND uidvalidity != ?", key)
+                self.db.executemany(
+                    "DELETE FROM messages WHERE account = ? AND method = ? AND mbox = ? AND uidvalidity = ? AND uid = ?",
+                    [key + (uid,) for uid in stale],
+                )
+        return to_fetch
+
+    def save(self, mbox: str, fingerprints: List[Tuple[int, bytes]]):
+        """
+        Record the fingerprints of newly checked messages in the mailbox
+        last passed to load(), given as (uid, fingerprint) pairs.
+        """
+        if self.readonly or self.uidvalidity is None:
+            return
+        rows = [(self.account, self.method, mbox, self.uidvalidity, uid, fp) for uid, fp in fingerprints]
+        for i in range(0, len(rows), 1000):
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows[i: i + 1000])
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+def connect(options, warn: bool = True) -> imaplib.IMAP4:
+    """
+    Connect and log in to the IMAP server given in the options, exiting
+    with an error message if either fails.
+    """
     serverclass: Type[Any]
     if options.process:
         serverclass = imaplib.IMAP4_stream
@@ -410,7 +732,7 @@ def process(options, mboxes: List[str]):
     elif options.starttls:
         sys.stderr.write("\nError: Server did not offer TLS\n")
         sys.exit(1)
-    elif not options.ssl:
+    elif not options.ssl and warn:
         sys.stderr.write("\nWarning: Unencrypted connection\n")
 
     try:
@@ -424,6 +746,157 @@ def process(options, mboxes: List[str]):
         sys.stderr.write("\nError: Login failed\n")
         sys.exit(1)
 
+    if not options.process:
+        # Servers often advertise more capabilities, such as ESEARCH, once logged in.
+        server.capabilities = tuple(check_response(server.capability())[-1].decode().upper().split())
+
+    return server
+
+class MailboxScan:
+    """
+    Examines the given mailbox and, when iterated over, yields
+    (msgnum, uid, message key, parsed headers) for each undeleted message
+    in it, reporting progress as it goes.  The key is None for messages
+    which couldn't be identified.  The headers are only parsed if they're
+    needed, which, when identifying messages by Message-ID alone, is only
+    if they'll be shown.  If a cache is given, the messages it knows about
+    are added to msg_ids instead of being fetched.  The server mustn't be
+    used for anything else until the iteration is complete.
+
+    Once the mailbox has been examined, its UIDVALIDITY is available as
+    the uidvalidity attribute, so that the UIDs can be checked before
+    they're used.
+    """
+
+    def __init__(self, server: imaplib.IMAP4, options, mbox: str, fields: List[str],
+                 msg_ids: Optional[Dict[bytes, Tuple[str, int]]] = None,
+                 cache: Optional[FingerprintCache] = None):
+        self.log: Callable[[str], None] = print
+        self.output: List[str] = []
+        self.server = server
+        self.options = options
+        self.mbox = mbox
+        self.fields = fields
+        self.msg_ids = msg_ids
+        self.cache = cache
+        self.uidvalidity: Optional[int] = None
+        self.results: Optional[List[Tuple[int, int, Optional[bytes], Optional[Message]]]] = None
+
+    def __iter__(self) -> Iterator[Tuple[int, int, Optional[bytes], Optional[Message]]]:
+        if self.results is not None:
+            for line in self.output:
+                print(line)
+            return iter(self.results)
+        return self.scan()
+
+    def read(self, keep_headers: bool) -> "MailboxScan":
+        """
+        Scan the mailbox now, perhaps in another thread, keeping the
+        results to be iterated over later.  The progress messages are
+        kept too, and printed when it is, so that each mailbox's report
+        stays in one piece.  The parsed headers are only kept if
+        keep_headers is set.
+        """
+        self.log = self.output.append
+        self.results = [(mnum, uid, key, mp if keep_headers else None) for mnum, uid, key, mp in self.scan()]
+        return self
+
+    def scan(self) -> Iterator[Tuple[int, int, Optional[bytes], Optional[Message]]]:
+        server, options, mbox, log = self.server, self.options, self.mbox, self.log
+        parser = BytesHeaderParser()
+        need_headers = options.use_checksum or options.verbose or options.show
+
+        # Look for duplicates with the mailbox opened read-only (EXAMINE),
+        # so the server needn't lock it against other clients meanwhile.
+        msgs = check_response(server.select(mailbox=mbox, readonly=True))[0]
+        log("There are %d messages in %s." % (int(msgs), mbox))
+        uidvalidity = server.response("UIDVALIDITY")[1][0]
+        self.uidvalidity = int(uidvalidity) if uidvalidity else None
+
+        numdeleted = count_matching_msgnums(server, "DELETED", options.sent_before, log=log)
+        log(f'{numdeleted or "No"} message(s) currently marked as deleted in {mbox}')
+
+        msgnums = get_undeleted_msgnums(server, options.sent_before, log=log)
+        log(f"{len(msgnums)} others in {mbox}")
+
+        if self.cache:
+            msgnums = self.cache.load(server, mbox, self.uidvalidity, msgnums, self.msg_ids)
+            log(f"{len(msgnums)} of them not checked by an earlier run")
+
+        chunkSize = 100
+        if options.verbose:
+            log("Reading the others... (in batches of %d)" % chunkSize)
+
+        for i, batch in prefetch_msg_headers(server, msgnums, chunkSize, self.fields,
+                                             interval=options.rate_limit_ms / 1000, log=log):
+            if options.verbose:
+                log("Batch starting at item %d" % i)
+            try:
+                for mnum, uid, hinfo in batch.result():
+                    if options.verbose:
+                        log(f"Checking {mbox} message {mnum}")
+                    msg_id = None if need_headers else get_raw_message_id(hinfo)
+                    if msg_id is not None:
+                        yield (mnum, uid, msg_id, None)
+                    else:
+                        mp = parser.parsebytes(hinfo)
+                        yield (mnum, uid, get_message_id(mp, options.use_checksum, options.use_id_in_checksum, log), mp)
+            except Exception as e:
+                log(f"Error processing batch starting at item {i}: {e}")
+            log(f"{min(len(msgnums), i + chunkSize)} message(s) in {mbox} processed")
+
+def scan_mailboxes_in_parallel(server: imaplib.IMAP4, options, mboxes: List[str], fields: List[str],
+                               keepalive: float = 60) -> Iterator[MailboxScan]:
+    """
+    Scan the given mailboxes using up to options.workers threads, each
+    with its own connection to the server, and yield each one's completed
+    MailboxScan, in order.  The parsed headers are only kept if they'll
+    be shown.  To bound the memory used, each mailbox is only queued as
+    an earlier one's results are taken, so no more than options.workers
+    scans are ever running or waiting to be taken.  While waiting for a scan, the given server, which the
+    caller uses to act on the results, is sent a NOOP every 'keepalive'
+    seconds so that it isn't logged out for inactivity.
+    """
+    keep_headers = options.verbose or options.show
+    local = threading.local()
+    servers: List[imaplib.IMAP4] = []
+    lock = threading.Lock()
+
+    def scan(mbox: str) -> MailboxScan:
+        if not hasattr(local, "server"):
+            local.server = connect(options, warn=False)
+            with lock:
+                servers.append(local.server)
+        return MailboxScan(local.server, options, mbox, fields).read(keep_headers)
+
+    workers = min(options.workers, len(mboxes))
+    queued = iter(mboxes)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending: deque = deque(pool.submit(scan, mbox) for mbox in islice(queued, workers))
+            while pending:
+                future = pending.popleft()
+                while True:
+                    try:
+                        result = future.result(timeout=keepalive)
+                        break
+                    except FutureTimeoutError:
+                        check_response(server.noop())
+                # Start on the next mailbox while the caller handles this one.
+                for mbox in islice(queued, 1):
+                    pending.append(pool.submit(scan, mbox))
+                yield result
+    finally:
+        for worker_server in servers:
+            try:
+                worker_server.logout()
+            except (imaplib.IMAP4.error, OSError):
+                # It has done its job, so a broken connection no longer matters.
+                pass
+
+def process(options, mboxes: List[str]):
+    server = connect(options)
+
     if options.just_list:
         for mb in get_mailbox_list(server):
             print(mb)
@@ -448,66 +921,97 @@ def process(options, mboxes: List[str]):
     if len(mboxes) > 1:
         print("Working with mailboxes in order: %s" % (", ".join(mboxes)))
 
+    # Optional pause between batches, in seconds.
+    rate_limit = options.rate_limit_ms / 1000
+
+    # Wording for reporting duplicates, which is the same for every message.
+    verb = "would" if options.dry_run else "will"
+    action = "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted"
+
+    # Only fetch the headers we'll use: those needed to identify each message,
+    # plus enough to describe it in the messages we print.
+    if options.use_checksum or options.verbose or options.show:
+        fields = list(checksum_headers) + ["Message-ID"]
+    else:
+        fields = ["Message-ID", "From", "Subject", "Date"]
+
+    cache = None
+    if options.cache_path:
+        if options.use_checksum:
+            method = "checksum-with-id" if options.use_id_in_checksum else "checksum"
+        else:
+            method = "message-id"
+        # The mailboxes belong to the user being logged in as, not the admin user.
+        if options.process:
+            account = f"process:{options.process}"
+        else:
+            account = f"{options.user}@{options.server}:{options.port or ''}"
+        cache = FingerprintCache(options.cache_path, account, method, readonly=options.dry_run)
+
+    mboxes = [add_quotes(mb) for mb in mboxes]
+    # Maps each message key to the (mailbox, number) where it was first seen.
+    msg_ids: Dict[bytes, Tuple[str, int]] = {}
+
+    # The mailbox last opened read-write, if any, for the final CLOSE.
+    selected = None
+
     try:
-        parser = BytesParser()
-        msg_ids: Dict[str, str] = {}
-        for mbox in mboxes:
+        # Mailboxes can only be read ahead of time if nothing we do to one
+        # can change another before we get to it.
+        independent = len(set(mboxes)) == len(mboxes) and (
+            not options.copy_mailbox or add_quotes(options.copy_mailbox) not in mboxes
+        )
+        if options.workers > 1 and len(mboxes) > 1 and independent:
+            scans = scan_mailboxes_in_parallel(server, options, mboxes, fields)
+        else:
+            scans = (MailboxScan(server, options, mbox, fields, msg_ids, cache) for mbox in mboxes)
+        for mbox, scan in zip(mboxes, scans):
+            # The duplicates are identified by UID, since their numbers can
+            # change if other clients expunge messages before we act.
             msgs_to_delete = []
             msg_map = {}
 
-            mbox = add_quotes(mbox)
-            msgs = check_response(server.select(mailbox=mbox, readonly=options.dry_run))[0]
-            print("There are %d messages in %s." % (int(msgs), mbox))
-
-            numdeleted = len(get_deleted_msgnums(server, options.sent_before))
-            print(f'{numdeleted or "No"} message(s) currently marked as deleted in {mbox}')
+            # Messages kept as the first copy, to be remembered for next time.
+            new_fingerprints = []
 
-            msgnums = get_undeleted_msgnums(server, options.sent_before)
-            print(f"{len(msgnums)} others in {mbox}")
+            for mnum, uid, msg_id, mp in scan:
+                if options.verbose:
+                    # Save parsed message for verbose output
+                    msg_map[uid] = mp
+                if msg_id:
+                    if msg_id in msg_ids:
+                        print("Message %s_%s is a duplicate of %s and %s be %s" % (
+                            mbox, mnum, "%s_%s" % msg_ids[msg_id], verb, action,
+                        ))
+                        if options.show or options.verbose:
+                            print("Subject: %s\nFrom: %s\nDate: %s\n" % (mp["Subject"], mp["From"], mp["Date"]))
+                        msgs_to_delete.append(uid)
+                    else:
+                        msg_ids[msg_id] = (mbox, mnum)
+                        if cache:
+                            new_fingerprints.append((uid, msg_id))
 
-            chunkSize = 100
-            if options.verbose:
-                print("Reading the others... (in batches of %d)" % chunkSize)
+            if cache:
+                cache.save(mbox, new_fingerprints)
 
-            for i in range(0, len(msgnums), chunkSize):
-                if options.verbose:
-                    print("Batch starting at item %d" % i)
-                try:
-                    for mnum, hinfo in get_msg_headers(server, msgnums[i: i + chunkSize]):
-                        if options.verbose:
-                            print(f"Checking {mbox} message {mnum}")
-                            # Save parsed message for verbose output
-                            msg_map[mnum] = parser.parsebytes(hinfo)
-                        mp = parser.parsebytes(hinfo)
-                        msg_id = get_message_id(mp, options.use_checksum, options.use_id_in_checksum)
-                        if msg_id:
-                            if msg_id in msg_ids:
-                                print("Message %s_%s is a duplicate of %s and %s be %s" % (
-                                    mbox, mnum, msg_ids[msg_id],
-                                    options.dry_run and "would" or "will",
-                                    "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted",
-                                ))
-                                if options.show or options.verbose:
-                                    print("Subject: %s\nFrom: %s\nDate: %s\n" % (mp["Subject"], mp["From"], mp["Date"]))
-                                msgs_to_delete.append(mnum)
-                            else:
-                                msg_ids[msg_id] = f"{mbox}_{mnum}"
-                except Exception as e:
-                    print(f"Error processing batch starting at item {i}: {e}")
-                print(f"{min(len(msgnums), i + chunkSize)} message(s) in {mbox} processed")
-                time.sleep(1)  # Short pause between batches to avoid overloading the server
+            if not options.dry_run and (msgs_to_delete or options.delete_marked_messages):
+                check_response(server.select(mailbox=mbox))
+                uidvalidity = server.response("UIDVALIDITY")[1][0]
+                if scan.uidvalidity is not None and uidvalidity and int(uidvalidity) != scan.uidvalidity:
+                    sys.stderr.write(f"\nWarning: The UIDs in {mbox} changed while it was being checked, so it has been left alone.\n")
+                    continue
+                selected = mbox
 
             if not msgs_to_delete:
                 print(f"No duplicates were found in {mbox}")
             else:
                 if options.verbose:
                     print("These are the duplicate messages: ")
-                    for mnum in msgs_to_delete:
-                        print_message_info(msg_map[mnum])
+                    for uid in msgs_to_delete:
+                        print_message_info(msg_map[uid])
                 if options.dry_run:
                     print("If you had NOT selected the 'dry-run' option,\n  %i messages would now be %s." % (
-                        len(msgs_to_delete),
-                        "tagged as '%s'" % options.tag_name if options.tag_name else "marked as deleted",
+                        len(msgs_to_delete), action,
                     ))
                 else:
                     if options.copy_mailbox:
@@ -516,53 +1020,63 @@ def process(options, mboxes: List[str]):
                         print("Tagging %i messages as '%s'..." % (len(msgs_to_delete), options.tag_name))
                     else:
                         print("Marking %i messages as deleted..." % (len(msgs_to_delete)))
-                    batch_size = 15
+                    batch_size = 500
                     if options.verbose:
                         print("(in batches of %d)" % batch_size)
                     for i in range(0, len(msgs_to_delete), batch_size):
+                        if i and rate_limit:
+                            time.sleep(rate_limit)
 
                         process_messages(server, msgs_to_delete[i: i + batch_size], options.tag_name, options.copy_mailbox)
 
                         if options.verbose:
                             print("Batch starting at item %d marked." % i)
                     print("Confirming new numbers...")
-                    numdeleted = len(get_deleted_msgnums(server, options.sent_before))
-                    numundel = len(get_undeleted_msgnums(server, options.sent_before))
+                    numdeleted = count_matching_msgnums(server, "DELETED", options.sent_before)
+                    numundel = count_matching_msgnums(server, "UNDELETED", options.sent_before)
                     print("There are now %s messages marked as deleted and %s others in %s." % (numdeleted, numundel, mbox))
                     if options.tag_name:
-                        numtagged = len(get_tagged_msgnums(server, options.tag_name, options.sent_before))
+                        numtagged = count_matching_msgnums(server, f"KEYWORD {options.tag_name}", options.sent_before)
                         print("There are now %s messages tagged as '%s' in %s." % (numtagged, options.tag_name, mbox))
             if options.delete_marked_messages:
-                delete_marked_messages(server)
-        if not options.no_close:
+                if options.dry_run:
+                    # The mailbox was only examined, and may not be selected at all.
+                    print("If you had NOT selected the 'dry-run' option,\n  messages marked as deleted in %s would now be expunged." % mbox)
+                else:
+                    delete_marked_messages(server)
+        # As before, only the last mailbox is closed, and now only if it was
+        # opened for changes; closing one which was merely examined purges nothing.
+        if not options.no_close and selected == mboxes[-1]:
             server.close()
     except ImapDedupException as e:
         print("Error:", e, file=sys.stderr)
     finally:
+        if cache:
+            cache.close()
         server.logout()
 
 def process_messages(server: imaplib.IMAP4, msgs_to_delete: List[int], tag_name: Optional[str] = None,
                      copy_mailbox: Optional[str] = None, retries: int = 3, pause: int = 5):
     """
-    Process the messages: either mark them as deleted or tag them,
+    Process the messages, given by UID: either mark them as deleted or tag them,
     and copy them if a copy mailbox is specified.
     Retries the operation if an error occurs.
     """
-    message_ids = ",".join(map(str, msgs_to_delete))
+    message_ids = compress_seqset(msgs_to_delete)
     action = tag_name or r"(\Deleted)"
 
     for attempt in range(1, retries + 1):
         try:
             if copy_mailbox:
-                check_response(server.copy(message_ids, copy_mailbox))
+                check_response(server.uid("COPY", message_ids, copy_mailbox))
 
-            check_response(server.store(message_ids, "+FLAGS", action))
-            time.sleep(1)  # Short pause between batches to avoid overloading the server
+            check_response(server.uid("STORE", message_ids, "+FLAGS", action))
             break  # Exit the loop if operation succeeds
         except Exception as e:
             if attempt < retries:
                 print(f"Attempt {attempt} failed: {e}. Retrying in {pause} seconds...")
                 time.sleep(pause)
+                pause *= 2
             else:
                 print(f"Attempt {attempt} failed: {e}. No more retries left.")
                 raise  # Re-raise the last exception if all retries fail